@@ -8,4 +8,5 @@ setup(
     author_email="brandizzi@diag.uniroma1.it",
     url="https://github.com/nicofirst1/CorpusCompass",
     install_requires=["tqdm", "nltk", "pandas", "numpy"],
+    extras_require={"fast": ["charset-normalizer"]},
 )
@@ -1,18 +1,40 @@
+import functools
+import itertools
 import re
 import string
-from collections import Counter
+from bisect import bisect_right
+from collections import Counter, deque
+from concurrent.futures import Executor
 from copy import copy
-from typing import Tuple, List, Dict, Optional
+from typing import Tuple, List, Dict, Optional, Set, Callable, Iterator, Iterable
 
 import nltk
+import numpy as np
 
 from dataset_analyzer.colors import *
 
+try:
+    from charset_normalizer import from_bytes
+except ImportError:
+    from_bytes = None
+
 nltk.download('punkt')
 
 from nltk import word_tokenize
 
 
+@functools.lru_cache(maxsize=512)
+def compile_regex(pattern: str) -> re.Pattern:
+    """
+    Compile a regex, caching the result so that asking again for the same pattern does not compile it twice.
+    Only the 512 most recently used patterns are kept.
+    :param pattern: the regex to compile
+    :return: the compiled regex
+    """
+
+    return re.compile(pattern)
+
+
 def check_correct_annotations(annotations: List[re.Match], corpus: str, corpus_path:str, verbose: bool = True) -> Tuple[
     List[str], List[Tuple[str, str]]]:
     """
@@ -54,7 +76,7 @@ def check_correct_annotations(annotations: List[re.Match], corpus: str, corpus_p
             incorrect_annotations.append((group, get_context(ann, ngram_params)))
             continue
         # elif if the number of square brackets is greater than 1
-        elif len(re.findall(r"\[|\]", group)) > 2:
+        elif group.count("[") + group.count("]") > 2:
             custom_print(
                 f"The annotation '{group}' contains more than one square bracket. Please remove them and try again.")
             incorrect_annotations.append((group, get_context(ann, ngram_params)))
@@ -133,6 +155,36 @@ def get_ngram(corpus: str, ngram_params: Tuple[int, int], index: int, square_reg
     return result
 
 
+def bom_encoding(to_decode: bytes) -> Optional[str]:
+    """
+    Get the encoding of a corpus from its byte order mark
+    :param to_decode: the corpus to decode
+    :return: the encoding given by the byte order mark, None if there is none
+    """
+
+    if to_decode[:3] == b"\xef\xbb\xbf":
+        return "utf-8-sig"
+    if to_decode[:2] in (b"\xff\xfe", b"\xfe\xff"):
+        return "utf-16"
+
+    return None
+
+
+def guess_encoding(to_decode: bytes) -> Optional[str]:
+    """
+    Guess the encoding of a corpus from a sample of its start
+    :param to_decode: the corpus to decode
+    :return: the guessed encoding, None if it could not be guessed
+    """
+
+    if from_bytes is not None:
+        best = from_bytes(to_decode[:65536]).best()
+        if best is not None:
+            return best.encoding
+
+    return None
+
+
 def multi_corpus_upload(corpus_list: Dict[str, bytes], encoding: Optional[str] = "utf-16") -> Dict[str, str]:
     """
     Upload multiple corpus
@@ -141,12 +193,21 @@ def multi_corpus_upload(corpus_list: Dict[str, bytes], encoding: Optional[str] =
     alternative_encodings = [encoding] + ["utf-8", "utf-16", "latin-1", "ascii", "cp1252", "cp1250", "cp1251",
                                           "cp1253", ]
 
+    def candidates(to_decode) -> Iterator[str]:
+        # a byte order mark is trusted over the given encoding
+        bom = bom_encoding(to_decode)
+        if bom is not None:
+            yield bom
+        yield from alternative_encodings
+        # guessing is slow and often wrong on short texts, so it is only tried when all the others failed
+        guess = guess_encoding(to_decode)
+        if guess is not None and guess not in alternative_encodings:
+            yield guess
+
     def decode(to_decode) -> str:
-        idx = 0
         dec = ""
         success = False
-        while idx < len(alternative_encodings):
-            encoding = alternative_encodings[idx]
+        for idx, encoding in enumerate(candidates(to_decode)):
 
             if idx > 0:
                 info(f"Trying with the encoding {encoding}.")
@@ -157,13 +218,11 @@ def multi_corpus_upload(corpus_list: Dict[str, bytes], encoding: Optional[str] =
                 if " " not in dec:
                     warning(
                         f"The corpus {k} has been read with the encoding {encoding}, but it seems that it did not work.")
-                    idx += 1
                     continue
 
             except UnicodeDecodeError as e:
                 warning(f"Could not decode the corpus {k} with the encoding {encoding}.\n"
                       f"The error is: {e}\n")
-                idx += 1
                 continue
             success = True
             break
@@ -258,6 +317,309 @@ def find_repetitions(corpus: str, token: str, annotation_regex: re.Pattern, name
     return total_wild_rep, interested_wild_rep, ann_rep, wild_index
 
 
+def blank_annotations(text: str, annotations: Iterable[re.Match], name_regex: re.Pattern) -> str:
+    """
+    Replace the annotations and the speaker names in a text with spaces, what is left are the not-annotated words
+    at the same positions they have in the text
+    :param text: the paragraphs of a file joined with newlines
+    :param annotations: the matches of the annotations in the text
+    :param name_regex: the regex to find the name of the speaker in a paragraph
+    :return: the text without annotations and speaker names
+    """
+
+    plain = []
+    last = 0
+    for ann in annotations:
+        plain.append(text[last:ann.start()])
+        plain.append(" " * (ann.end() - ann.start()))
+        last = ann.end()
+    plain.append(text[last:])
+
+    paragraphs = []
+    for p in "".join(plain).split("\n"):
+        name = name_regex.search(p)
+        if name is not None:
+            p = " " * name.end() + p[name.end():]
+        paragraphs.append(p)
+
+    return "\n".join(paragraphs)
+
+
+def find_plain_tokens(plain: str, tokens: Set[str]) -> List[Tuple[str, int, int]]:
+    """
+    Find the not-annotated occurrences of some tokens in a text whose annotations have been removed.
+    A word is an occurrence of a token if it is the token as it is, without a trailing '.' or ',', or without
+    the punctuation around it, e.g. 'ana and 'ana, are occurrences of 'ana and (ana) is an occurrence of ana.
+    Tokens containing spaces are matched as whole phrases.
+    :param plain: the text without annotations
+    :param tokens: the tokens to look for
+    :return: the token, start and end of every occurrence, first all the single words and then the phrases
+    """
+
+    found = []
+
+    for w in compile_regex(r"\S+").finditer(plain):
+        word = w.group()
+        for token in (word, word.rstrip(".,"), word.strip(string.punctuation)):
+            if token in tokens:
+                found.append((token, w.start(), w.end()))
+                break
+
+    # annotated words can contain spaces, look for those in the text as a whole
+    for phrase in [t for t in tokens if " " in t]:
+        phrase_regex = compile_regex(rf"(?<!\S){re.escape(phrase)}(?![^\s{re.escape(string.punctuation)}])")
+        for w in phrase_regex.finditer(plain):
+            found.append((phrase, w.start(), w.end()))
+
+    return found
+
+
+def find_not_annotated(corpus: str, tokens: List[str], annotation_regex: re.Pattern,
+                       name_regex: re.Pattern) -> Dict[str, List[str]]:
+    """
+    Find the not-annotated repetitions of many tokens with a single pass over a corpus
+    :param corpus: the corpus
+    :param tokens: the tokens to look for
+    :param annotation_regex: the regex to find the annotations
+    :param name_regex: the regex to find the name of the speaker in a paragraph
+    :return: a dictionary mapping every token found outside an annotation to the contexts it appears in,
+    in the same order as tokens
+    """
+
+    # context n-gram
+    char_ngram = (+50, 50)
+
+    # positions in the plain text are the same as in the corpus
+    plain = blank_annotations(corpus, annotation_regex.finditer(corpus), name_regex)
+
+    found = {}
+    for token, start, end in find_plain_tokens(plain, set(tokens)):
+        lower_bound = max(start - char_ngram[0], 0)
+        upper_bound = min(end + char_ngram[1], len(corpus))
+        found.setdefault(token, []).append(corpus[lower_bound:upper_bound])
+
+    return {t: found[t] for t in tokens if t in found}
+
+
+def count_occurrences(tok_ids: np.ndarray, spk_ids: np.ndarray, is_ann: np.ndarray,
+                      n_speakers: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Count the occurrences of every (token, speaker, annotated) triple
+    :param tok_ids: the id of the token for every occurrence
+    :param spk_ids: the id of the speaker for every occurrence
+    :param is_ann: whether every occurrence is annotated
+    :param n_speakers: the number of distinct speakers
+    :return: a tuple with the token ids, speaker ids, annotated flags and counts of the triples that occur
+    """
+
+    flat = (tok_ids.astype(np.int64) * n_speakers + spk_ids) * 2 + is_ann
+    keys, counts = np.unique(flat, return_counts=True)
+    keys, ann = np.divmod(keys, 2)
+    tok, spk = np.divmod(keys, n_speakers)
+
+    return tok, spk, ann, counts
+
+
+def build_occurrence_index(corpus_dict: Dict[str, List[Tuple[str, str]]], feat_regex: re.Pattern,
+                           name_regex: re.Pattern,
+                           joined_corpus: Optional[Dict[str, str]] = None) -> Dict[str, Dict[str, int]]:
+    """
+    Count the annotated and not-annotated occurrences of every annotated token with a single pass over the corpus
+    :param corpus_dict: a dictionary mapping every file to its list of (speaker, paragraph) tuples
+    :param feat_regex: the regex to find the content of an annotation
+    :param name_regex: the regex to use to remove the name of the speaker from the paragraph
+    :param joined_corpus: optional dictionary mapping every file to its paragraphs already joined with newlines
+    :return: a dictionary mapping every annotated token to its counters:
+    - 'annotated' and 'not annotated' for the whole corpus
+    - '<speaker> annotated' and '<speaker> not annotated' for every speaker with a non-zero count
+    """
+
+    token_ids = {}
+    speaker_ids = {}
+    tok_ids = []
+    spk_ids = []
+    is_ann = []
+    plain_files = []
+
+    for path, paragraphs in corpus_dict.items():
+        speakers = [speaker_ids.setdefault(s, len(speaker_ids)) for s, _ in paragraphs]
+
+        # scan the whole file at once and map every annotation back to its paragraph
+        if joined_corpus is not None:
+            text = joined_corpus[path]
+        else:
+            text = "\n".join([p for _, p in paragraphs])
+        starts = list(itertools.accumulate([len(p) + 1 for _, p in paragraphs[:-1]], initial=0))
+        annotations = list(feat_regex.finditer(text))
+        for ann in annotations:
+            # the token is the last field of the annotation
+            token = ann.group(1).split(".")[-1]
+            tok_ids.append(token_ids.setdefault(token, len(token_ids)))
+            spk_ids.append(speakers[bisect_right(starts, ann.start()) - 1])
+            is_ann.append(True)
+
+        # positions in the plain text are the same as in the file, so the paragraph starts still apply
+        plain_files.append((speakers, starts, blank_annotations(text, annotations, name_regex)))
+
+    # only the annotated tokens are counted among the not-annotated words
+    token_set = set(token_ids)
+    for speakers, starts, plain in plain_files:
+        for token, start, _ in find_plain_tokens(plain, token_set):
+            tok_ids.append(token_ids[token])
+            spk_ids.append(speakers[bisect_right(starts, start) - 1])
+            is_ann.append(False)
+
+    triples = count_occurrences(np.array(tok_ids, dtype=np.int32), np.array(spk_ids, dtype=np.int32),
+                                np.array(is_ann, dtype=np.int8), len(speaker_ids))
+
+    tokens = list(token_ids)
+    speakers = list(speaker_ids)
+    index = {token: {"annotated": 0, "not annotated": 0} for token in tokens}
+
+    # only the (token, speaker) pairs that actually occur are counted
+    for t, s, a, n in zip(*triples):
+        occurrences = index[tokens[t]]
+        if a:
+            occurrences["annotated"] += int(n)
+            occurrences[f"{speakers[s]} annotated"] = int(n)
+        else:
+            occurrences["not annotated"] += int(n)
+            occurrences[f"{speakers[s]} not annotated"] = int(n)
+
+    return index
+
+
+def process_file(file_path: str, corpus: List[Tuple[str, str]], ctx: Dict) -> Tuple[List[List], Set[str]]:
+    """
+    Build the dataset rows for the annotations of the speakers of interest in a file.
+    Files are independent of each other, so this can run in a separate process for each of them
+    :param file_path: the path of the file
+    :param corpus: the list of (speaker, paragraph) tuples of the file
+    :param ctx: a dictionary with the settings shared by all the files:
+    - csv_header, header_idx: the header of the dataset and the position of every column in it
+    - tokens: the valid annotated tokens
+    - speakers_of_interest: the set of speakers to build the rows for
+    - independent_variable_dict, idv: the independent variables and the inverse of all the variables
+    - square_regex, feat_regex: the regexes to find the complete annotation and its content
+    - ngram_params, previous_line: the context size and whether to add the previous line
+    :return: a tuple with the rows of the file and the unknown categories found in it
+    """
+
+    csv_header = ctx["csv_header"]
+    header_idx = ctx["header_idx"]
+    idv = ctx["idv"]
+    square_regex = ctx["square_regex"]
+
+    file_speakers = sorted(set([s for s, _ in corpus]))
+    # the interlocutors of a speaker are all the other speakers in the file
+    interlocutors_for = {sp: ",".join([s for s in file_speakers if s != sp]) for sp in file_speakers}
+    csv_file = []
+    unk_categories = set()
+
+    for idx in range(len(corpus)):
+        cur_speaker, c = corpus[idx]
+
+        # get the paragraph without features
+        if cur_speaker in ctx["speakers_of_interest"]:
+            sp = corpus[idx - 1][1]
+        else:
+            continue
+
+        clean_p, wrong_tags = remove_features(c, square_regex)
+
+        # get the features
+        tags = ctx["feat_regex"].finditer(c)
+
+        # for every tags with features in the paragraph
+        for t in tags:
+            # get index of result + tag
+            index = t.start()
+            org_t = t.group(0)
+            t = t.group(1)
+
+            # skip annotations that are not valid
+            if t.split(".")[-1] not in ctx["tokens"]:
+                warning(f"\nSkipping '{t}' because it is not valid")
+                continue
+
+            # skip any tags that are wrongly formatted
+            if any([t in wt for wt in wrong_tags]):
+                warning(f"\nSkipping '{t}' because it is wrongly formatted")
+                continue
+
+            # initialize empty row
+            csv_line = ["" for _ in range(len(csv_header))]
+
+            # get independent variable information
+            for k, v in ctx["independent_variable_dict"].items():
+                if cur_speaker != k:
+                    continue
+                for var in v:
+                    category = idv[var]
+                    cat_idx = header_idx[category]
+                    csv_line[cat_idx] = var
+
+            # get the features
+            feats = t.rsplit(".", 1)
+            text = feats[1]
+            feats = feats[0]
+
+            context = get_ngram(c, ctx["ngram_params"], index, square_regex)
+
+            # for every feature in the word
+            unk_parts = []
+            for f in feats.split("."):
+                # if the category is not present in the dict, then add to unk
+                if f not in idv.keys():
+                    unk_categories.add(f)
+                    unk_parts.append(f)
+                else:
+                    category = idv[f]
+                    cat_idx = header_idx[category]
+                    csv_line[cat_idx] = f
+
+            # add initial infos and final unk to the line
+            # ["speaker", "interlocutor/s", "file", 'context', 'unk']
+
+            csv_line[0] = text
+            csv_line[-2] = context
+            csv_line[-3] = file_path
+            csv_line[-4] = interlocutors_for[cur_speaker]
+            csv_line[-5] = cur_speaker
+            if ctx["previous_line"]:
+                csv_line[-6] = sp
+
+            csv_line[-1] = ",".join(unk_parts)
+            csv_file.append(csv_line)
+
+    return csv_file, unk_categories
+
+
+def bounded_map(executor: Optional[Executor], fn: Callable, *iterables, max_pending: int) -> Iterator:
+    """
+    Like executor.map, but submit a call only when fewer than max_pending results are waiting to be yielded,
+    so that the results after a slow call do not pile up in memory
+    :param executor: the executor to run the calls in, None to run them one at a time in this process
+    :param fn: the function to call
+    :param iterables: the arguments of every call, as in map
+    :param max_pending: the maximum number of calls submitted and not yet yielded
+    :return: the results, in the same order as the arguments
+    """
+
+    if executor is None:
+        yield from map(fn, *iterables)
+        return
+
+    pending = deque()
+    for args in zip(*iterables):
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, *args))
+
+    while pending:
+        yield pending.popleft().result()
+
+
 def count_tokens(corpus: str, remove_punctuation=True):
     """
     Count the number of tokens in a corpus